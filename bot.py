@@ -1,15 +1,25 @@
 import os
-import json
+import re
+import logging
+import sys
+import pickle
 import datetime as dt
+import time
 import random
 import string
-from dataclasses import dataclass
+import asyncio
+import heapq
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from dataclasses import fields
 from typing import Dict, Any, Optional, List, Tuple
 
 import aiosqlite
+import orjson
 from dotenv import load_dotenv
+from rapidfuzz import fuzz, process
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, Router
 from aiogram.filters import Command
 from aiogram.types import (
     Message,
@@ -19,16 +29,25 @@ from aiogram.types import (
 )
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 
+import countries
 from countries import COUNTRY_TO_CONTINENT, norm_country
+from feedback import POS_RU, build_feedback_spotle_multiline
+from models import Player
 
 load_dotenv()
 
 DB_PATH = "game.db"
 PLAYERS_PATH = "players.json"
 PUZZLES_PATH = "puzzles.json"
+# разобранный players.json; пересобирается, если json изменился
+PLAYERS_CACHE_PATH = "players.pkl"
+PLAYERS_CACHE_VERSION = 6  # увеличить, если меняется логика load_players
 
 MAX_ATTEMPTS = 10
 SUGGEST_LIMIT = 8
+FUZZY_CUTOFF = 85  # минимальный fuzz.ratio, чтобы опечатка засчиталась как игрок
+FUZZY_MARGIN = 5  # насколько лучший игрок должен обойти второго, иначе — кнопки
+SUGGEST_FUZZY_CUTOFF = 75  # порог похожих написаний в подсказках (кнопки, не засчёт)
 
 # --- DEV (кто может ставить игрока на дату) ---
 # В .env добавь DEV_USER_IDS="123,456" (это telegram user_id)
@@ -41,201 +60,273 @@ if _raw_dev:
         DEV_USER_IDS = set()
 
 
-# -------------------- Models --------------------
-@dataclass
-class Player:
-    id: str
-    name: str
-    aliases: List[str]
-    debut_year: int
-    iconic_club: str
-    fifa_rating: int
-    value_eur: int
-    position_group: str  # GK/DEF/MID/FWD
-    birth_country: str
-    club_emoji: str = ""
+# -------------------- Load data --------------------
+_WS = re.compile(r"\s+")
 
 
-# -------------------- Load data --------------------
+@lru_cache(maxsize=4096)
 def norm(s: str) -> str:
-    return " ".join(str(s).strip().lower().split())
+    return _WS.sub(" ", str(s).strip().lower())
+
+
+def continent_of(country: str) -> str:
+    c = norm_country(country)
+    return COUNTRY_TO_CONTINENT.get(c, "unknown")
+
+
+def _players_cache_key() -> Tuple[Any, ...]:
+    # country_n/continent в кэше считаются по countries.py — правка таблицы
+    # континентов тоже должна сбрасывать кэш, а не только правка players.json
+    st = os.stat(PLAYERS_PATH)
+    st_c = os.stat(countries.__file__)
+    return (
+        PLAYERS_CACHE_VERSION,
+        st.st_mtime_ns,
+        st.st_size,
+        st_c.st_mtime_ns,
+        st_c.st_size,
+        tuple(f.name for f in fields(Player)),
+    )
+
+
+# ключ сортировки подсказки — одно int: (позиция << 48) | tail, где
+# tail = ((65535 - fifa_rating) << 32) | номер записи; записи идут по pid, так что
+# порядок тот же, что у кортежа (pos, -fifa_rating, pid)
+_SEARCH_POS_SHIFT = 48
+_SEARCH_I_MASK = 0xFFFFFFFF
+
+# индекс поиска — параллельные массивы по номеру записи (blobs, tails, pids)
+# плюс триграммы; цикл поиска берёт из них только нужное, без распаковки кортежей
+SearchIndex = Tuple[List[str], List[int], List[str], Dict[str, List[int]]]
+
+
+def build_search_index(by_id: Dict[str, Player]) -> SearchIndex:
+    # search index for substring matches (name + aliases)
+    blobs: List[str] = []
+    tails: List[int] = []
+    pids: List[str] = []
+    for i, pid in enumerate(sorted(by_id)):
+        p = by_id[pid]
+        blobs.append(p.name_n + " " + " ".join(p.aliases))
+        tails.append(((65535 - p.fifa_rating) << 32) | i)
+        pids.append(pid)
 
+    # триграмма -> номера блобов, где она встречается.
+    # Любая подстрока длиной >= 3 содержит все свои триграммы, поэтому кандидаты —
+    # это список самой редкой триграммы запроса, а blob.find лишь проверяет их
+    trigram_index: Dict[str, List[int]] = {}
+    for i, blob in enumerate(blobs):
+        for tri in {blob[j:j + 3] for j in range(len(blob) - 2)}:
+            trigram_index.setdefault(tri, []).append(i)
 
-def load_players() -> Tuple[Dict[str, Player], Dict[str, str]]:
-    with open(PLAYERS_PATH, "r", encoding="utf-8") as f:
-        raw = json.load(f)
+    return blobs, tails, pids, trigram_index
+
+
+def load_players() -> Tuple[Dict[str, Player], Dict[str, str], SearchIndex]:
+    # в кэше лежит всё, что строится из players.json, включая индексы поиска:
+    # тёплый старт — один pickle.load без разбора и нормализации
+    cache_key = _players_cache_key()
+    try:
+        with open(PLAYERS_CACHE_PATH, "rb") as f:
+            key, by_id, alias_to_id, search_index = pickle.load(f)
+        if key == cache_key:
+            # после unpickle строки уже не интернированы — возвращаем это
+            alias_to_id = {sys.intern(k): v for k, v in alias_to_id.items()}
+            return by_id, alias_to_id, search_index
+    except Exception:
+        pass  # кэша нет или он битый — просто собираем заново
+
+    with open(PLAYERS_PATH, "rb") as f:
+        raw = orjson.loads(f.read())
 
     by_id: Dict[str, Player] = {}
     alias_to_id: Dict[str, str] = {}
 
     for x in raw:
+        name = str(x["name"])
+        iconic_club = str(x.get("iconic_club", ""))
+        birth_country = str(x.get("birth_country", ""))
         p = Player(
-            id=str(x["id"]),
-            name=str(x["name"]),
-            aliases=[norm(a) for a in x.get("aliases", [])],
+            id=sys.intern(str(x["id"])),
+            name=name,
+            aliases=tuple(norm(a) for a in x.get("aliases", [])),
             debut_year=int(x.get("debut_year", 2005)),
-            iconic_club=str(x.get("iconic_club", "")),
+            iconic_club=iconic_club,
             fifa_rating=int(x.get("fifa_rating", 0)),
             value_eur=int(x.get("value_eur", 0)),
             position_group=str(x.get("position_group", "MID")).upper(),
-            birth_country=str(x.get("birth_country", "")),
+            birth_country=birth_country,
             club_emoji=str(x.get("club_emoji", "") or ""),
+            name_n=norm(name),
+            club_n=norm(iconic_club),
+            country_n=norm_country(birth_country),
+            continent=continent_of(birth_country),
         )
         by_id[p.id] = p
 
-        alias_to_id[norm(p.id)] = p.id
-        alias_to_id[norm(p.name)] = p.id
-        for a in p.aliases:
-            alias_to_id[norm(a)] = p.id
+        # ключи интернируем: одинаковые алиасы разных игроков — один объект.
+        # Запросы пользователей не интернируем — в 3.12+ такие строки бессмертны
+        alias_to_id[sys.intern(norm(p.id))] = p.id
+        alias_to_id[sys.intern(p.name_n)] = p.id
+        for a in p.aliases:  # уже нормализованы
+            alias_to_id[sys.intern(a)] = p.id
+
+    search_index = build_search_index(by_id)
+
+    try:
+        with open(PLAYERS_CACHE_PATH, "wb") as f:
+            pickle.dump(
+                (cache_key, by_id, alias_to_id, search_index),
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+    except OSError:
+        pass  # read-only FS и т.п. — работаем без кэша
 
-    return by_id, alias_to_id
+    return by_id, alias_to_id, search_index
 
 
 def load_puzzles() -> Dict[str, Any]:
-    with open(PUZZLES_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(PUZZLES_PATH, "rb") as f:
+        return orjson.loads(f.read())
 
 
-PLAYERS_BY_ID, ALIAS_TO_ID = load_players()
+PLAYERS_BY_ID, ALIAS_TO_ID, (SEARCH_BLOBS, SEARCH_TAILS, SEARCH_PIDS, TRIGRAM_INDEX) = load_players()
 PUZZLES = load_puzzles()
 
-# search index for substring matches (name + aliases)
-SEARCH_INDEX: List[Tuple[str, str]] = []
-for pid, p in PLAYERS_BY_ID.items():
-    blob = norm(p.name) + " " + " ".join(norm(a) for a in p.aliases)
-    SEARCH_INDEX.append((blob, pid))
+# страна без континента в countries.py всегда даёт ⬜️ вместо 🟨 — предупреждаем при старте
+_UNKNOWN_COUNTRIES = sorted(
+    {p.country_n for p in PLAYERS_BY_ID.values() if p.country_n and p.continent == "unknown"}
+)
+if _UNKNOWN_COUNTRIES:
+    logging.warning("countries.py: нет континента для %s", ", ".join(_UNKNOWN_COUNTRIES))
+
+
+def _search_candidates(qn: str) -> List[int]:
+    best: Optional[List[int]] = None
+    for j in range(len(qn) - 2):
+        posting = TRIGRAM_INDEX.get(qn[j:j + 3])
+        if posting is None:
+            return []
+        if best is None or len(posting) < len(best):
+            best = posting
+    return best or []
 
 
 def find_players_by_substring(q: str, limit: int = SUGGEST_LIMIT) -> List[Player]:
     qn = norm(q)
     if len(qn) < 3:
         return []
-    hits = []
-    for blob, pid in SEARCH_INDEX:
-        pos = blob.find(qn)
+    keys = []
+    for i in _search_candidates(qn):
+        pos = SEARCH_BLOBS[i].find(qn)
         if pos != -1:
-            p = PLAYERS_BY_ID[pid]
-            hits.append((pos, -p.fifa_rating, pid))
-    hits.sort()
-    return [PLAYERS_BY_ID[pid] for _, __, pid in hits[:limit]]
-
-
-def puzzle_player_of_the_day(today: Optional[dt.date] = None) -> Player:
-    if today is None:
-        today = dt.date.today()
-    order = PUZZLES.get("order", [])
-    if not order:
-        raise RuntimeError("puzzles.json: поле order пустое")
-    idx = today.toordinal() % len(order)
-    pid = order[idx]
-    if pid not in PLAYERS_BY_ID:
-        raise RuntimeError(f"puzzles.json: player id '{pid}' не найден в players.json")
-    return PLAYERS_BY_ID[pid]
-
-
-def random_player_from_pool() -> Player:
-    order = PUZZLES.get("order", [])
-    pid = random.choice(order) if order else random.choice(list(PLAYERS_BY_ID.keys()))
-    return PLAYERS_BY_ID[pid]
-
-
-def resolve_guess_to_player(text: str) -> Optional[Player]:
-    pid = ALIAS_TO_ID.get(norm(text))
-    return PLAYERS_BY_ID.get(pid) if pid else None
-
-
-# -------------------- UI / feedback (Spotle-like) --------------------
-GREEN = "🟩"
-YELLOW = "🟨"
-GREY = "⬜️"
-
-POS_RU = {"GK": "Вратарь", "DEF": "Защитник", "MID": "Полузащитник", "FWD": "Нападающий"}
-
-
-def continent_of(country: str) -> str:
-    c = norm_country(country)
-    return COUNTRY_TO_CONTINENT.get(c, "unknown")
-
-
-def country_color(guess_country: str, answer_country: str) -> str:
-    g0 = norm_country(guess_country)
-    a0 = norm_country(answer_country)
-    if g0 == a0:
-        return GREEN
-    g = continent_of(g0)
-    a = continent_of(a0)
-    if g != "unknown" and g == a:
-        return YELLOW
-    return GREY
-
+            keys.append((pos << _SEARCH_POS_SHIFT) | SEARCH_TAILS[i])
+    return [
+        PLAYERS_BY_ID[SEARCH_PIDS[k & _SEARCH_I_MASK]]
+        for k in heapq.nsmallest(limit, keys)
+    ]
 
-def arrow_need(guess_val: int, answer_val: int) -> str:
-    if guess_val == answer_val:
-        return "✅"
-    return "⬆️" if answer_val > guess_val else "⬇️"
 
+# порядок "игры дня" не меняется во время работы — считаем один раз
+_ORDER: Tuple[str, ...] = tuple(PUZZLES.get("order", []))
+_ORDER_LEN = len(_ORDER)
 
-def color_numeric(guess_val: int, answer_val: int, near_delta: int) -> str:
-    if guess_val == answer_val:
-        return GREEN
-    if abs(guess_val - answer_val) <= near_delta:
-        return YELLOW
-    return GREY
+# неизвестный id в order — ошибка данных: падаем при старте, а не в день, когда он выпадет
+_MISSING_ORDER_IDS = sorted({pid for pid in _ORDER if pid not in PLAYERS_BY_ID})
+if _MISSING_ORDER_IDS:
+    raise RuntimeError(
+        "puzzles.json: player id не найдены в players.json: " + ", ".join(_MISSING_ORDER_IDS)
+    )
 
+# игроки "игры дня" по порядку: ответ на день — один индекс в кортеже
+_ORDER_PLAYERS: Tuple[Player, ...] = tuple(PLAYERS_BY_ID[pid] for pid in _ORDER)
 
-def color_bool(ok: bool) -> str:
-    return GREEN if ok else GREY
+# пул для случайной игры, если order пуст (без нового списка ключей на каждый /play)
+_ALL_PIDS: Tuple[str, ...] = tuple(PLAYERS_BY_ID)
 
 
-def fmt_money_eur(v: int) -> str:
-    if v >= 1_000_000:
-        return f"€{v/1_000_000:.0f}m"
-    if v >= 1_000:
-        return f"€{v/1_000:.0f}k"
-    return f"€{v}"
+def puzzle_player_of_the_day(today: Optional[dt.date] = None) -> Player:
+    if today is None:
+        today = dt.date.today()
+    if not _ORDER_LEN:
+        raise RuntimeError("puzzles.json: поле order пустое")
+    return _ORDER_PLAYERS[today.toordinal() % _ORDER_LEN]
 
 
-def build_feedback_spotle_multiline(guess: Player, answer: Player) -> str:
-    debut_color = color_numeric(guess.debut_year, answer.debut_year, near_delta=2)
-    debut_arrow = arrow_need(guess.debut_year, answer.debut_year)
+def random_player_from_pool() -> Player:
+    return PLAYERS_BY_ID[random.choice(_ORDER or _ALL_PIDS)]
 
-    club_ok = norm(guess.iconic_club) == norm(answer.iconic_club)
-    club_color = color_bool(club_ok)
-    club_value = f"{guess.club_emoji} {guess.iconic_club}".strip()
 
-    fifa_color = color_numeric(guess.fifa_rating, answer.fifa_rating, near_delta=20)
-    fifa_arrow = arrow_need(guess.fifa_rating, answer.fifa_rating)
+# все известные написания (уже нормализованные) для нечёткого поиска
+ALIAS_CHOICES: List[str] = list(ALIAS_TO_ID.keys())
 
-    value_color = color_numeric(guess.value_eur, answer.value_eur, near_delta=5_000_000)
-    value_arrow = arrow_need(guess.value_eur, answer.value_eur)
 
-    pos_ok = guess.position_group == answer.position_group
-    pos_color = color_bool(pos_ok)
+def _resolve_typo(qn: str) -> Optional[str]:
+    # опечатка засчитывается сразу, только если она однозначна: по подстроке никого нет
+    # (иначе это неполный ввод — пусть выбирает кнопкой), а лучший игрок заметно
+    # обходит следующего; попытка стоит дорого, угадывать за пользователя нельзя
+    if len(qn) < 3 or find_players_by_substring(qn, limit=1):
+        return None
+    best_pid = None
+    best_score = 0.0
+    for alias, score, _i in process.extract(
+        qn, ALIAS_CHOICES, scorer=fuzz.ratio, processor=None,
+        limit=SUGGEST_LIMIT * 3, score_cutoff=FUZZY_CUTOFF - FUZZY_MARGIN,
+    ):
+        pid = ALIAS_TO_ID[alias]
+        if best_pid is None:
+            if score < FUZZY_CUTOFF:
+                return None
+            best_pid, best_score = pid, score
+        elif pid != best_pid:
+            # результаты идут по убыванию: это второй по счёту игрок
+            return best_pid if best_score - score >= FUZZY_MARGIN else None
+    return best_pid
+
+
+def resolve_guess_to_player(text: str, fuzzy: bool = True) -> Optional[Player]:
+    qn = norm(text)
+    pid = ALIAS_TO_ID.get(qn)
+    if pid is None and fuzzy:
+        pid = _resolve_typo(qn)
+    return PLAYERS_BY_ID.get(pid) if pid else None
 
-    ctry_color = country_color(guess.birth_country, answer.birth_country)
 
-    lines = [
-        f"{debut_color} Debut: {guess.debut_year} {debut_arrow}",
-        f"{club_color} Club: {club_value}",
-        f"{fifa_color} FIFA: {guess.fifa_rating} {fifa_arrow if fifa_arrow != '✅' else '✅'}",
-        f"{value_color} Value: {fmt_money_eur(guess.value_eur)} {value_arrow}",
-        f"{pos_color} Position: {POS_RU.get(guess.position_group, guess.position_group)}",
-        f"{ctry_color} Nationality: {guess.birth_country}",
-    ]
-    return "\n".join(lines)
+def suggest_players(q: str, limit: int = SUGGEST_LIMIT) -> List[Player]:
+    # сначала совпадения по подстроке, недостающее добираем похожими написаниями
+    found = find_players_by_substring(q, limit=limit)
+    qn = norm(q)
+    if len(found) >= limit or len(qn) < 3:
+        return found
+
+    seen = {p.id for p in found}
+    # у игрока несколько алиасов — берём с запасом, дубли отсекаем по pid
+    for alias, _score, _i in process.extract(
+        qn, ALIAS_CHOICES, scorer=fuzz.ratio, processor=None,
+        limit=limit * 3, score_cutoff=SUGGEST_FUZZY_CUTOFF,
+    ):
+        pid = ALIAS_TO_ID[alias]
+        if pid not in seen:
+            seen.add(pid)
+            found.append(PLAYERS_BY_ID[pid])
+            if len(found) >= limit:
+                break
+    return found
 
 
 # -------------------- DB --------------------
 CREATE_TABLES_SQL = """
+-- created_at везде — unix-время в секундах (int(time.time()))
 CREATE TABLE IF NOT EXISTS user_sessions (
   user_id INTEGER NOT NULL,
   session_key TEXT NOT NULL,
   answer_id TEXT NOT NULL,
   attempts INTEGER NOT NULL DEFAULT 0,
   finished INTEGER NOT NULL DEFAULT 0,
-  created_at TEXT NOT NULL,
+  created_at INTEGER NOT NULL,
   PRIMARY KEY (user_id, session_key)
-);
+) WITHOUT ROWID;
 
 CREATE TABLE IF NOT EXISTS user_attempts (
   user_id INTEGER NOT NULL,
@@ -244,7 +335,9 @@ CREATE TABLE IF NOT EXISTS user_attempts (
   guess TEXT NOT NULL,
   feedback TEXT NOT NULL,
   PRIMARY KEY (user_id, session_key, n)
-);
+) WITHOUT ROWID;
+-- WITHOUT ROWID: строки лежат прямо в B-дереве первичного ключа, так что get_history
+-- (/status) и DELETE при сбросе сессии читают один диапазон без отдельного индекса
 
 CREATE TABLE IF NOT EXISTS user_active (
   user_id INTEGER PRIMARY KEY,
@@ -255,23 +348,17 @@ CREATE TABLE IF NOT EXISTS challenges (
   code TEXT PRIMARY KEY,
   answer_id TEXT NOT NULL,
   creator_user_id INTEGER NOT NULL,
-  created_at TEXT NOT NULL
+  created_at INTEGER NOT NULL
 );
 
--- purpose: 'guess' | 'challenge'
-CREATE TABLE IF NOT EXISTS user_suggestions (
-  user_id INTEGER PRIMARY KEY,
-  token TEXT NOT NULL,
-  purpose TEXT NOT NULL,
-  created_at TEXT NOT NULL,
-  choices_json TEXT NOT NULL
-);
+-- подсказки теперь живут в памяти (SUGGESTIONS), старая таблица не нужна
+DROP TABLE IF EXISTS user_suggestions;
 
 -- flow: None | challenge_create | challenge_join
 CREATE TABLE IF NOT EXISTS user_flow (
   user_id INTEGER PRIMARY KEY,
   mode TEXT,
-  created_at TEXT NOT NULL
+  created_at INTEGER NOT NULL
 );
 
 -- overrides for "game of the day" (dev only)
@@ -280,157 +367,311 @@ CREATE TABLE IF NOT EXISTS daily_overrides (
   date_iso TEXT PRIMARY KEY,
   player_id TEXT NOT NULL,
   set_by_user_id INTEGER NOT NULL,
-  created_at TEXT NOT NULL
+  created_at INTEGER NOT NULL
 );
 """
 
+# --- SQL: все запросы — константы модуля, один и тот же текст на каждый вызов,
+# так что statement cache sqlite3 на общем соединении всегда попадает ---
+SQL_GET_ACTIVE = "SELECT session_key FROM user_active WHERE user_id=?"
+
+# активная сессия и её состояние одним запросом (answer_id=NULL — сессии нет)
+SQL_GET_ACTIVE_AND_SESSION = (
+    "SELECT a.session_key, s.answer_id, s.attempts, s.finished FROM user_active a "
+    "LEFT JOIN user_sessions s USING(user_id, session_key) WHERE a.user_id=?"
+)
+
+# +1 попытка и finished=1, если угадал или попытки кончились
+SQL_ADD_ATTEMPT = (
+    "UPDATE user_sessions SET attempts=attempts+1, "
+    "finished=CASE WHEN attempts+1 >= ? OR ? THEN 1 ELSE finished END "
+    "WHERE user_id=? AND session_key=? RETURNING attempts, finished"
+)
+
+SQL_INSERT_ATTEMPT = (
+    "INSERT INTO user_attempts(user_id, session_key, n, guess, feedback) VALUES(?, ?, ?, ?, ?)"
+)
+
+SQL_FINISH_SESSION = "UPDATE user_sessions SET finished=1 WHERE user_id=? AND session_key=?"
+
+SQL_SET_ACTIVE = (
+    "INSERT INTO user_active(user_id, session_key) VALUES(?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET session_key=excluded.session_key"
+)
+
+SQL_DELETE_ATTEMPTS = "DELETE FROM user_attempts WHERE user_id=? AND session_key=?"
+
+SQL_RESET_SESSION = (
+    "INSERT INTO user_sessions(user_id, session_key, answer_id, attempts, finished, created_at) "
+    "VALUES(?, ?, ?, 0, 0, ?) "
+    "ON CONFLICT(user_id, session_key) DO UPDATE SET answer_id=excluded.answer_id, "
+    "attempts=0, finished=0, created_at=excluded.created_at"
+)
+
+SQL_GET_HISTORY = (
+    "SELECT n, guess, feedback FROM user_attempts WHERE user_id=? AND session_key=? ORDER BY n"
+)
+
+SQL_GET_CHALLENGE = "SELECT answer_id FROM challenges WHERE code=?"
+
+SQL_SET_FLOW = (
+    "INSERT INTO user_flow(user_id, mode, created_at) VALUES(?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET mode=excluded.mode, created_at=excluded.created_at"
+)
+
+SQL_GET_FLOW = "SELECT mode FROM user_flow WHERE user_id=?"
+
+SQL_CLEAR_FLOW = "DELETE FROM user_flow WHERE user_id=?"
+
+SQL_GET_DAILY_OVERRIDE = "SELECT player_id FROM daily_overrides WHERE date_iso=?"
+
+SQL_SET_DAILY_OVERRIDE = (
+    "INSERT INTO daily_overrides(date_iso, player_id, set_by_user_id, created_at) VALUES(?, ?, ?, ?) "
+    "ON CONFLICT(date_iso) DO UPDATE SET player_id=excluded.player_id, "
+    "set_by_user_id=excluded.set_by_user_id, created_at=excluded.created_at"
+)
+
+SQL_CLEAR_DAILY_OVERRIDE = "DELETE FROM daily_overrides WHERE date_iso=?"
+
+
+# одно долгоживущее соединение на весь процесс (открывается в init_db)
+DB: Optional[aiosqlite.Connection] = None
+
+
+# WAL + synchronous=NORMAL: один fsync на commit и читатели не ждут писателя
+DB_PRAGMAS_SQL = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-20000;
+PRAGMA busy_timeout=2000;
+"""
+
+
+async def open_db() -> aiosqlite.Connection:
+    # запросов пара десятков — все помещаются в statement cache с запасом
+    db = await aiosqlite.connect(DB_PATH, cached_statements=256)
+    await db.executescript(DB_PRAGMAS_SQL)
+    return db
+
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript(CREATE_TABLES_SQL)
-        await db.commit()
+    global DB
+    DB = await open_db()
+    await DB.executescript(CREATE_TABLES_SQL)
+    # статистика для планировщика запросов
+    await DB.execute("ANALYZE")
+    await DB.commit()
+
+
+# SQLite пишет последовательно, а соединение общее: без блокировки commit одного
+# хендлера зафиксировал бы недописанные изменения другого
+DB_LOCK = asyncio.Lock()
+
+# user_id -> (session_key, answer_id, attempts, finished) активной игры.
+# Write-through: хелперы ниже обновляют его вместе с БД, так что попытка читает
+# состояние из памяти, а в БД идут только UPDATE/INSERT. После рестарта — промах и
+# один SELECT; при rollback кэш сбрасывается целиком, чтобы не пережить отменённое.
+# Держим только незавершённые игры: завершение убирает запись, а брошенные игры
+# вытесняются самыми старыми при переполнении (промах стоит лишь один SELECT)
+SESSION_CACHE: Dict[int, Tuple[str, Optional[str], Optional[int], Optional[int]]] = {}
+SESSION_CACHE_MAX = 10_000
+
+
+def _cache_session(
+    user_id: int, row: Tuple[str, Optional[str], Optional[int], Optional[int]]
+):
+    if row[3] == 1:
+        SESSION_CACHE.pop(user_id, None)
+        return
+    if user_id not in SESSION_CACHE and len(SESSION_CACHE) >= SESSION_CACHE_MAX:
+        del SESSION_CACHE[next(iter(SESSION_CACHE))]
+    SESSION_CACHE[user_id] = row
+
+
+@asynccontextmanager
+async def db_write():
+    # BEGIN IMMEDIATE: чтения хендлера (активная сессия, попытки) и его записи — одна
+    # транзакция с блокировкой записи с самого начала, даже если на время деплоя
+    # базу открыл второй процесс бота; commit (и fsync) — один на хендлер
+    async with DB_LOCK:
+        await DB.execute("BEGIN IMMEDIATE")
+        try:
+            yield DB
+            await DB.commit()
+        except BaseException:
+            SESSION_CACHE.clear()
+            await DB.rollback()
+            raise
 
 
 async def set_active_session(db, user_id: int, session_key: str):
-    await db.execute(
-        "INSERT INTO user_active(user_id, session_key) VALUES(?, ?) "
-        "ON CONFLICT(user_id) DO UPDATE SET session_key=excluded.session_key",
-        (user_id, session_key)
-    )
+    SESSION_CACHE.pop(user_id, None)
+    await db.execute(SQL_SET_ACTIVE, (user_id, session_key))
 
 
 async def get_active_session(db, user_id: int) -> Optional[str]:
-    cur = await db.execute("SELECT session_key FROM user_active WHERE user_id=?", (user_id,))
+    cached = SESSION_CACHE.get(user_id)
+    if cached is not None:
+        return cached[0]
+    cur = await db.execute(SQL_GET_ACTIVE, (user_id,))
     row = await cur.fetchone()
     return row[0] if row else None
 
 
-async def create_or_reset_session(db, user_id: int, session_key: str, answer_id: str):
-    await db.execute(
-        "DELETE FROM user_attempts WHERE user_id=? AND session_key=?",
-        (user_id, session_key)
-    )
-    await db.execute(
-        "INSERT INTO user_sessions(user_id, session_key, answer_id, attempts, finished, created_at) "
-        "VALUES(?, ?, ?, 0, 0, ?) "
-        "ON CONFLICT(user_id, session_key) DO UPDATE SET answer_id=excluded.answer_id, attempts=0, finished=0, created_at=excluded.created_at",
-        (user_id, session_key, answer_id, dt.datetime.utcnow().isoformat())
-    )
+async def get_active_and_session(db, user_id: int):
+    # (session_key, answer_id, attempts, finished) или None, если активной игры нет
+    row = SESSION_CACHE.get(user_id)
+    if row is None:
+        cur = await db.execute(SQL_GET_ACTIVE_AND_SESSION, (user_id,))
+        row = await cur.fetchone()
+        if row is not None:
+            _cache_session(user_id, row)
+    return row
 
 
-async def get_session(db, user_id: int, session_key: str):
-    cur = await db.execute(
-        "SELECT answer_id, attempts, finished FROM user_sessions WHERE user_id=? AND session_key=?",
-        (user_id, session_key)
-    )
-    return await cur.fetchone()
+async def create_or_reset_session(db, user_id: int, session_key: str, answer_id: str):
+    SESSION_CACHE.pop(user_id, None)
+    await db.execute(SQL_DELETE_ATTEMPTS, (user_id, session_key))
+    await db.execute(SQL_RESET_SESSION, (user_id, session_key, answer_id, int(time.time())))
 
 
-async def add_attempt(db, user_id: int, session_key: str, guess: str, feedback: str):
-    row = await get_session(db, user_id, session_key)
+async def add_attempt_and_maybe_finish(
+    db, user_id: int, session_key: str, guess: str, feedback: str, finish: bool
+) -> Tuple[int, int]:
+    # UPDATE (+1 попытка, finished=1 при finish или исчерпании попыток) с RETURNING
+    # и INSERT попытки — в одной транзакции вызывающего db_write(), без SELECT
+    cur = await db.execute(SQL_ADD_ATTEMPT, (MAX_ATTEMPTS, int(finish), user_id, session_key))
+    row = await cur.fetchone()
+    await cur.close()
     if not row:
         raise RuntimeError("Session not found when adding attempt")
 
-    _answer_id, attempts, _finished = row
-    n = attempts + 1
-
-    await db.execute(
-        "UPDATE user_sessions SET attempts=? WHERE user_id=? AND session_key=?",
-        (n, user_id, session_key)
-    )
-    await db.execute(
-        "INSERT INTO user_attempts(user_id, session_key, n, guess, feedback) VALUES(?, ?, ?, ?, ?)",
-        (user_id, session_key, n, guess, feedback)
-    )
+    n, finished = row
+    await db.execute(SQL_INSERT_ATTEMPT, (user_id, session_key, n, guess, feedback))
+    _update_cached_session(user_id, session_key, n, finished)
+    return n, finished
 
 
 async def finish_session(db, user_id: int, session_key: str):
-    await db.execute(
-        "UPDATE user_sessions SET finished=1 WHERE user_id=? AND session_key=?",
-        (user_id, session_key)
-    )
+    await db.execute(SQL_FINISH_SESSION, (user_id, session_key))
+    _update_cached_session(user_id, session_key, None, 1)
+
+
+def _update_cached_session(
+    user_id: int, session_key: str, attempts: Optional[int], finished: int
+):
+    cached = SESSION_CACHE.get(user_id)
+    if cached is not None and cached[0] == session_key:
+        _cache_session(user_id, (session_key, cached[1], attempts, finished))
 
 
 async def get_history(db, user_id: int, session_key: str) -> List[Tuple[int, str, str]]:
-    cur = await db.execute(
-        "SELECT n, guess, feedback FROM user_attempts WHERE user_id=? AND session_key=? ORDER BY n",
-        (user_id, session_key)
-    )
+    cur = await db.execute(SQL_GET_HISTORY, (user_id, session_key))
     return await cur.fetchall()
 
 
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+TOKEN_ALPHABET = string.ascii_lowercase + string.digits
+
+
+def _byte_table(alphabet: str) -> bytes:
+    # байт -> символ алфавита (b % len): случайные байты переводятся одним translate.
+    # 256 не делится на 36, первые 4 символа выпадают чуть чаще (8/256 против 7/256) —
+    # для кодов и токенов это неважно
+    a = alphabet.encode()
+    return bytes(a[b % len(a)] for b in range(256))
+
+
+# байты из os.urandom (системный CSPRNG): коды челленджей раздаются публично
+_CODE_TABLE = _byte_table(CODE_ALPHABET)
+_TOKEN_TABLE = _byte_table(TOKEN_ALPHABET)
+
+# занятый код не вставится и не вернёт строку — без исключения и без SELECT
+SQL_INSERT_CHALLENGE = (
+    "INSERT INTO challenges(code, answer_id, creator_user_id, created_at) VALUES(?, ?, ?, ?) "
+    "ON CONFLICT(code) DO NOTHING RETURNING code"
+)
+
+
 def make_code(n: int = 6) -> str:
-    alphabet = string.ascii_uppercase + string.digits
-    return "".join(random.choice(alphabet) for _ in range(n))
+    return os.urandom(n).translate(_CODE_TABLE).decode()
 
 
 async def create_challenge(db, creator_user_id: int, answer_id: str) -> str:
-    for _ in range(40):
-        code = make_code(6)
-        try:
-            await db.execute(
-                "INSERT INTO challenges(code, answer_id, creator_user_id, created_at) VALUES(?, ?, ?, ?)",
-                (code, answer_id, creator_user_id, dt.datetime.utcnow().isoformat())
-            )
-            return code
-        except Exception:
-            continue
+    # 36^6 ≈ 2 млрд кодов: коллизия почти невозможна, повтор нужен на всякий случай
+    for _ in range(3):
+        cur = await db.execute(
+            SQL_INSERT_CHALLENGE, (make_code(6), answer_id, creator_user_id, int(time.time()))
+        )
+        row = await cur.fetchone()
+        await cur.close()
+        if row:
+            return row[0]
     raise RuntimeError("Не удалось создать уникальный код")
 
 
 async def get_challenge_answer(db, code: str) -> Optional[str]:
-    cur = await db.execute("SELECT answer_id FROM challenges WHERE code=?", (code,))
+    cur = await db.execute(SQL_GET_CHALLENGE, (code,))
     row = await cur.fetchone()
     return row[0] if row else None
 
 
 def _token(n: int = 10) -> str:
-    alphabet = string.ascii_lowercase + string.digits
-    return "".join(random.choice(alphabet) for _ in range(n))
-
-
-async def set_suggestions(db, user_id: int, choices: List[str], purpose: str) -> str:
+    return os.urandom(n).translate(_TOKEN_TABLE).decode()
+
+
+# ---- suggestions ----
+# Подсказки — короткоживущее состояние кнопок (выбор через секунды после запроса),
+# поэтому держим их в памяти, а не в SQLite: без UPSERT/SELECT/DELETE и commit.
+# На пользователя одна запись (новая перезаписывает старую); после рестарта кнопки
+# просто отвечают "Подсказки устарели"
+SUGGESTIONS_TTL = 600  # секунд
+
+# user_id -> (истекает в time.monotonic(), token, purpose, id игроков)
+# Порядок ключей = порядок истечения (запись всегда переносится в конец), так что
+# просроченные лежат в начале и снимаются при каждой записи, а не только по клику
+SUGGESTIONS: Dict[int, Tuple[float, str, str, List[str]]] = {}
+
+
+def set_suggestions(user_id: int, choices: List[str], purpose: str) -> str:
+    now = time.monotonic()
+    while SUGGESTIONS:
+        oldest = next(iter(SUGGESTIONS))
+        if SUGGESTIONS[oldest][0] >= now:
+            break
+        del SUGGESTIONS[oldest]
+    SUGGESTIONS.pop(user_id, None)
     token = _token(10)
-    await db.execute(
-        "INSERT INTO user_suggestions(user_id, token, purpose, created_at, choices_json) VALUES(?, ?, ?, ?, ?) "
-        "ON CONFLICT(user_id) DO UPDATE SET token=excluded.token, purpose=excluded.purpose, created_at=excluded.created_at, choices_json=excluded.choices_json",
-        (user_id, token, purpose, dt.datetime.utcnow().isoformat(), json.dumps(choices, ensure_ascii=False))
-    )
+    SUGGESTIONS[user_id] = (now + SUGGESTIONS_TTL, token, purpose, choices)
     return token
 
 
-async def get_suggestions(db, user_id: int) -> Optional[Tuple[str, str, List[str]]]:
-    cur = await db.execute("SELECT token, purpose, choices_json FROM user_suggestions WHERE user_id=?", (user_id,))
-    row = await cur.fetchone()
-    if not row:
+def get_suggestions(user_id: int) -> Optional[Tuple[str, str, List[str]]]:
+    row = SUGGESTIONS.get(user_id)
+    if row is None:
+        return None
+    expires, token, purpose, choices = row
+    if expires < time.monotonic():
+        del SUGGESTIONS[user_id]
         return None
-    token = row[0]
-    purpose = row[1]
-    try:
-        choices = json.loads(row[2])
-    except Exception:
-        choices = []
     return token, purpose, choices
 
 
-async def clear_suggestions(db, user_id: int):
-    await db.execute("DELETE FROM user_suggestions WHERE user_id=?", (user_id,))
+def clear_suggestions(user_id: int):
+    SUGGESTIONS.pop(user_id, None)
 
 
 # ---- flow helpers ----
 async def set_flow(db, user_id: int, mode: Optional[str]):
     if mode is None:
-        await db.execute("DELETE FROM user_flow WHERE user_id=?", (user_id,))
+        await db.execute(SQL_CLEAR_FLOW, (user_id,))
         return
-    await db.execute(
-        "INSERT INTO user_flow(user_id, mode, created_at) VALUES(?, ?, ?) "
-        "ON CONFLICT(user_id) DO UPDATE SET mode=excluded.mode, created_at=excluded.created_at",
-        (user_id, mode, dt.datetime.utcnow().isoformat())
-    )
+    await db.execute(SQL_SET_FLOW, (user_id, mode, int(time.time())))
 
 
 async def get_flow(db, user_id: int) -> Optional[str]:
-    cur = await db.execute("SELECT mode FROM user_flow WHERE user_id=?", (user_id,))
+    cur = await db.execute(SQL_GET_FLOW, (user_id,))
     row = await cur.fetchone()
     return row[0] if row else None
 
@@ -446,29 +687,26 @@ def parse_date_iso(s: str) -> Optional[str]:
 
 
 async def get_daily_override(db, date_iso: str) -> Optional[str]:
-    cur = await db.execute("SELECT player_id FROM daily_overrides WHERE date_iso=?", (date_iso,))
+    cur = await db.execute(SQL_GET_DAILY_OVERRIDE, (date_iso,))
     row = await cur.fetchone()
     return row[0] if row else None
 
 
 async def set_daily_override(db, date_iso: str, player_id: str, set_by_user_id: int):
     await db.execute(
-        "INSERT INTO daily_overrides(date_iso, player_id, set_by_user_id, created_at) VALUES(?, ?, ?, ?) "
-        "ON CONFLICT(date_iso) DO UPDATE SET player_id=excluded.player_id, set_by_user_id=excluded.set_by_user_id, created_at=excluded.created_at",
-        (date_iso, player_id, set_by_user_id, dt.datetime.utcnow().isoformat())
+        SQL_SET_DAILY_OVERRIDE, (date_iso, player_id, set_by_user_id, int(time.time()))
     )
 
 
 async def clear_daily_override(db, date_iso: str):
-    await db.execute("DELETE FROM daily_overrides WHERE date_iso=?", (date_iso,))
+    await db.execute(SQL_CLEAR_DAILY_OVERRIDE, (date_iso,))
 
 
 async def daily_player(today: Optional[dt.date] = None) -> Player:
     if today is None:
         today = dt.date.today()
     date_iso = today.isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        pid = await get_daily_override(db, date_iso)
+    pid = await get_daily_override(DB, date_iso)
     if pid and pid in PLAYERS_BY_ID:
         return PLAYERS_BY_ID[pid]
     return puzzle_player_of_the_day(today=today)
@@ -482,6 +720,9 @@ def build_suggest_kb(token: str, players: List[Player]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+# Статичные меню не зависят от пользователя — собираем (и валидируем в pydantic)
+# один раз и отдаём тот же объект; клавиатуры с токеном/сессией строятся на месте
+@lru_cache(maxsize=None)
 def main_menu_kb() -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton(text="🎲 Играть (случайный)", callback_data="menu:play")],
@@ -493,6 +734,7 @@ def main_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@lru_cache(maxsize=None)
 def persistent_reply_menu():
     kb = ReplyKeyboardBuilder()
     kb.button(text="🎲 Играть")
@@ -504,6 +746,7 @@ def persistent_reply_menu():
     return kb.as_markup(resize_keyboard=True)
 
 
+@lru_cache(maxsize=None)
 def challenge_menu_kb() -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton(text="➕ Создать", callback_data="challenge:create")],
@@ -521,94 +764,141 @@ def give_up_kb(session_key: str) -> InlineKeyboardMarkup:
 
 
 # -------------------- Shared actions --------------------
-async def handle_guess(user_id: int, reply_fn, guess_player: Player):
-    async with aiosqlite.connect(DB_PATH) as db:
-        session_key = await get_active_session(db, user_id)
-        if not session_key:
-            await reply_fn("Сначала начните игру: 🎲 Играть или /play")
-            return
+@lru_cache(maxsize=8192)
+def feedback_for(guess_id: str, answer_id: str) -> str:
+    # ответ (особенно дня) общий для многих, угадывают обычно одних и тех же
+    # игроков — строка фидбека для пары считается один раз
+    return build_feedback_spotle_multiline(PLAYERS_BY_ID[guess_id], PLAYERS_BY_ID[answer_id])
+
+
+async def apply_guess(
+    db, user_id: int, guess_player: Player
+) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    # вся работа с БД по попытке; возвращает (текст ответа, клавиатура)
+    row = await get_active_and_session(db, user_id)
+    if not row or not row[0]:
+        return "Сначала начните игру: 🎲 Играть или /play", None
+
+    session_key, answer_id, attempts, finished = row
+    if answer_id is None:
+        return "Сессия сломалась. Нажмите 🎲 Играть, чтобы начать заново.", None
+
+    if finished == 1:
+        return "Этот забег уже завершён. Нажмите 🎲 Играть, чтобы начать новый.", None
+
+    answer = PLAYERS_BY_ID.get(answer_id)
+    if not answer:
+        return "Не нашли загаданного игрока в базе. Нажмите 🎲 Играть.", None
+
+    if attempts >= MAX_ATTEMPTS:
+        await finish_session(db, user_id, session_key)
+        return f"😕 Попытки закончились. Ответ: {answer.name}\n\n🎲 Играть — новый раунд.", None
+
+    fb = feedback_for(guess_player.id, answer.id)
+    correct = guess_player.id == answer.id
+    attempt_no, finished = await add_attempt_and_maybe_finish(
+        db, user_id, session_key, guess_player.name, fb, finish=correct
+    )
 
-        row = await get_session(db, user_id, session_key)
-        if not row:
-            await reply_fn("Сессия сломалась. Нажмите 🎲 Играть, чтобы начать заново.")
-            return
+    if correct:
+        return (
+            f"Попытка {attempt_no}/{MAX_ATTEMPTS}\n"
+            f"🎉 Верно!\n{fb}\n\n🎲 Играть — новый раунд."
+        ), None
 
-        answer_id, attempts, finished = row
-        if finished == 1:
-            await reply_fn("Этот забег уже завершён. Нажмите 🎲 Играть, чтобы начать новый.")
-            return
+    if finished:
+        return (
+            f"Попытка {attempt_no}/{MAX_ATTEMPTS}\n"
+            f"{fb}\n\n😕 Попытки закончились. Ответ: {answer.name}\n\n🎲 Играть — новый раунд."
+        ), None
 
-        answer = PLAYERS_BY_ID.get(answer_id)
-        if not answer:
-            await reply_fn("Не нашли загаданного игрока в базе. Нажмите 🎲 Играть.")
-            return
+    return f"Попытка {attempt_no}/{MAX_ATTEMPTS}\n{fb}", give_up_kb(session_key)
 
-        if attempts >= MAX_ATTEMPTS:
-            await finish_session(db, user_id, session_key)
-            await db.commit()
-            await reply_fn(f"😕 Попытки закончились. Ответ: {answer.name}\n\n🎲 Играть — новый раунд.")
-            return
 
-        attempt_no = attempts + 1
-        fb = build_feedback_spotle_multiline(guess_player, answer)
-        await add_attempt(db, user_id, session_key, guess_player.name, fb)
+async def apply_give_up(db, user_id: int, session_key: str) -> Tuple[Optional[Player], str]:
+    # завершает сессию; возвращает (загаданный игрок, "") или (None, текст ошибки)
+    row = await get_active_and_session(db, user_id)
+    if not row or not row[0]:
+        return None, "Нет активной игры. Нажмите 🎲 Играть."
 
-        if guess_player.id == answer.id:
-            await finish_session(db, user_id, session_key)
-            await db.commit()
-            await reply_fn(
-                f"Попытка {attempt_no}/{MAX_ATTEMPTS}\n"
-                f"🎉 Верно!\n{fb}\n\n🎲 Играть — новый раунд."
-            )
-            return
+    active, answer_id, _attempts, finished = row
+    if active != session_key:
+        return None, "Кнопка относится к другой игре. Откройте текущую игру и нажмите там."
+    if answer_id is None:
+        return None, "Сессия сломалась. Нажмите 🎲 Играть, чтобы начать заново."
 
-        if attempt_no >= MAX_ATTEMPTS:
-            await finish_session(db, user_id, session_key)
-            await db.commit()
-            await reply_fn(
-                f"Попытка {attempt_no}/{MAX_ATTEMPTS}\n"
-                f"{fb}\n\n😕 Попытки закончились. Ответ: {answer.name}\n\n🎲 Играть — новый раунд."
-            )
-            return
+    if finished == 1:
+        return None, "Игра уже завершена."
 
-        await db.commit()
-        await reply_fn(
-            f"Попытка {attempt_no}/{MAX_ATTEMPTS}\n{fb}",
-            reply_markup=give_up_kb(session_key),
-        )
+    answer = PLAYERS_BY_ID.get(answer_id)
+    if not answer:
+        return None, "Не нашли загаданного игрока в базе. Нажмите 🎲 Играть."
+
+    await finish_session(db, user_id, session_key)
+    return answer, ""
+
+
+async def handle_guess(user_id: int, reply_fn, guess_player: Player):
+    # ответ в Telegram отправляем уже после commit, не держа блокировку БД
+    async with db_write() as db:
+        text, kb = await apply_guess(db, user_id, guess_player)
+    await reply_fn(text, reply_markup=kb)
+
+
+async def begin_session(db, user_id: int, session_key: str, answer_id: str):
+    # сброс попыток, активная сессия и чистка подсказок/флоу —
+    # вызывается внутри db_write(), т.е. одной транзакцией с одним commit
+    await create_or_reset_session(db, user_id, session_key, answer_id)
+    await set_active_session(db, user_id, session_key)
+    clear_suggestions(user_id)
+    await set_flow(db, user_id, None)
+    _cache_session(user_id, (session_key, answer_id, 0, 0))
 
 
-async def start_random_game(m: Message):
+# start_random_game/start_daily_game/show_status/show_help принимают (user_id, reply_fn),
+# как handle_guess: их зовут и команды (m.answer), и кнопки меню (cb.message.answer)
+async def start_random_game(user_id: int, reply_fn):
     p = random_player_from_pool()
     session_key = f"rand:{dt.datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{random.randint(1000,9999)}"
-    async with aiosqlite.connect(DB_PATH) as db:
-        await create_or_reset_session(db, m.from_user.id, session_key, p.id)
-        await set_active_session(db, m.from_user.id, session_key)
-        await clear_suggestions(db, m.from_user.id)
-        await set_flow(db, m.from_user.id, None)
-        await db.commit()
-    await m.answer(
+    async with db_write() as db:
+        await begin_session(db, user_id, session_key, p.id)
+    await reply_fn(
         "🎲 Новый раунд!\nПопыток: 10\nПишите имя игрока.",
         reply_markup=persistent_reply_menu()
     )
-    await m.answer("Можно сдаться в любой момент:", reply_markup=give_up_kb(session_key))
+    await reply_fn("Можно сдаться в любой момент:", reply_markup=give_up_kb(session_key))
 
 
-async def start_daily_game(m: Message):
+async def start_daily_game(user_id: int, reply_fn):
     day = dt.date.today().isoformat()
     p = await daily_player(dt.date.today())  # <-- override если есть, иначе puzzles.json
     session_key = f"daily:{day}"
-    async with aiosqlite.connect(DB_PATH) as db:
-        await create_or_reset_session(db, m.from_user.id, session_key, p.id)
-        await set_active_session(db, m.from_user.id, session_key)
-        await clear_suggestions(db, m.from_user.id)
-        await set_flow(db, m.from_user.id, None)
-        await db.commit()
-    await m.answer(
+    async with db_write() as db:
+        await begin_session(db, user_id, session_key, p.id)
+    await reply_fn(
         f"📅 Игра дня ({day}) началась заново.\nПопыток: 10\nПишите имя игрока.",
         reply_markup=persistent_reply_menu()
     )
-    await m.answer("Можно сдаться в любой момент:", reply_markup=give_up_kb(session_key))
+    await reply_fn("Можно сдаться в любой момент:", reply_markup=give_up_kb(session_key))
+
+
+async def show_status(user_id: int, reply_fn):
+    session_key = await get_active_session(DB, user_id)
+    if not session_key:
+        await reply_fn("Нет активной игры. Нажмите 🎲 Играть.", reply_markup=persistent_reply_menu())
+        return
+    hist = await get_history(DB, user_id, session_key)
+
+    if not hist:
+        await reply_fn(STATUS_NO_ATTEMPTS_TEXT.format(session_key))
+        return
+
+    await reply_fn("\n\n".join([f"{n}) {guess}\n{fb}" for n, guess, fb in hist]))
+
+
+async def show_help(user_id: int, reply_fn):
+    text = HELP_TEXT_DEV if is_dev(user_id) else HELP_TEXT
+    await reply_fn(text, reply_markup=persistent_reply_menu())
 
 
 async def start_join_code(m: Message, code: str):
@@ -618,16 +908,13 @@ async def start_join_code(m: Message, code: str):
         return
 
     session_key = f"chal:{code}"
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         answer_id = await get_challenge_answer(db, code)
-        if not answer_id:
-            await m.answer("Не нашли такой код 😕 Проверьте и попробуйте ещё раз.")
-            return
-        await create_or_reset_session(db, m.from_user.id, session_key, answer_id)
-        await set_active_session(db, m.from_user.id, session_key)
-        await clear_suggestions(db, m.from_user.id)
-        await set_flow(db, m.from_user.id, None)
-        await db.commit()
+        if answer_id:
+            await begin_session(db, m.from_user.id, session_key, answer_id)
+    if not answer_id:
+        await m.answer("Не нашли такой код 😕 Проверьте и попробуйте ещё раз.")
+        return
 
     await m.answer(
         f"🎯 Челлендж {code} начался!\nПопыток: 10\nПишите имя игрока.",
@@ -644,10 +931,9 @@ async def create_challenge_from_query(m: Message, query: str):
 
     p = resolve_guess_to_player(query)
     if p:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_write() as db:
             code = await create_challenge(db, m.from_user.id, p.id)
             await set_flow(db, m.from_user.id, None)
-            await db.commit()
 
         await m.answer(
             "✅ Челлендж создан!\n\n"
@@ -660,14 +946,12 @@ async def create_challenge_from_query(m: Message, query: str):
         )
         return
 
-    sugg = find_players_by_substring(query, limit=SUGGEST_LIMIT)
+    sugg = suggest_players(query)
     if not sugg:
         await m.answer("❓ Не нашли такого игрока. Попробуйте другое написание (минимум 3 символа).")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        token = await set_suggestions(db, m.from_user.id, [x.id for x in sugg], purpose="challenge")
-        await db.commit()
+    token = set_suggestions(m.from_user.id, [x.id for x in sugg], purpose="challenge")
 
     kb = build_suggest_kb(token, sugg)
     await m.answer("🔎 Нашли похожих — выберите кнопкой:", reply_markup=kb)
@@ -681,77 +965,76 @@ if not BOT_TOKEN:
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+# команды проверяются раньше общего текстового обработчика
+cmd_router = Router(name="commands")
+text_router = Router(name="text")
+# бот работает только в личке: фильтры на корне dp отсекают и команды, и свободный
+# текст, и кнопки — иначе в группе игра бы начиналась, а угадывания терялись
+dp.message.filter(F.chat.type == "private")
+dp.callback_query.filter(F.message.chat.type == "private")
+dp.include_routers(cmd_router, text_router)
+
 
 def is_dev(user_id: int) -> bool:
     # если DEV_USER_IDS пуст — никто не дев (безопаснее)
     return user_id in DEV_USER_IDS if DEV_USER_IDS else False
 
 
-@dp.message(Command("start"))
+# --- статические тексты: собираются один раз при импорте ---
+START_TEXT = (
+    "⚽️ Меню включено 🙂\n"
+    "Жмите кнопки снизу.\n\n"
+    "Команды: /play /daily /status /challenge <имя> /join <код>"
+)
+
+HELP_TEXT = (
+    "Обозначения:\n"
+    "🟩 точно\n"
+    "🟨 близко\n"
+    "⬜️ не совпало\n"
+    "⬆️/⬇️ куда двигаться\n\n"
+    "Попыток на забег: 10\n\n"
+    "Челлендж:\n"
+    "• 🎯 Челлендж → Создать/Подключиться\n"
+)
+
+HELP_TEXT_DEV = HELP_TEXT + (
+    "\nDEV-команды:\n"
+    "• /setdaily YYYY-MM-DD <имя>\n"
+    "• /cleardaily YYYY-MM-DD\n"
+    "• /getdaily YYYY-MM-DD\n"
+)
+
+STATUS_NO_ATTEMPTS_TEXT = "Активная игра: {}\nПока нет попыток. Пишите имя игрока."
+
+
+@cmd_router.message(Command("start"))
 async def cmd_start(m: Message):
-    await m.answer(
-        "⚽️ Меню включено 🙂\n"
-        "Жмите кнопки снизу.\n\n"
-        "Команды: /play /daily /status /challenge <имя> /join <код>",
-        reply_markup=persistent_reply_menu()
-    )
+    await m.answer(START_TEXT, reply_markup=persistent_reply_menu())
     await m.answer("Или меню тут:", reply_markup=main_menu_kb())
 
 
-@dp.message(Command("help"))
+@cmd_router.message(Command("help"))
 async def cmd_help(m: Message):
-    extra = ""
-    if is_dev(m.from_user.id):
-        extra = (
-            "\nDEV-команды:\n"
-            "• /setdaily YYYY-MM-DD <имя>\n"
-            "• /cleardaily YYYY-MM-DD\n"
-            "• /getdaily YYYY-MM-DD\n"
-        )
-    await m.answer(
-        "Обозначения:\n"
-        "🟩 точно\n"
-        "🟨 близко\n"
-        "⬜️ не совпало\n"
-        "⬆️/⬇️ куда двигаться\n\n"
-        "Попыток на забег: 10\n\n"
-        "Челлендж:\n"
-        "• 🎯 Челлендж → Создать/Подключиться\n"
-        + extra,
-        reply_markup=persistent_reply_menu()
-    )
+    await show_help(m.from_user.id, m.answer)
 
 
-@dp.message(Command("play"))
+@cmd_router.message(Command("play"))
 async def cmd_play(m: Message):
-    await start_random_game(m)
+    await start_random_game(m.from_user.id, m.answer)
 
 
-@dp.message(Command("daily"))
+@cmd_router.message(Command("daily"))
 async def cmd_daily(m: Message):
-    await start_daily_game(m)
+    await start_daily_game(m.from_user.id, m.answer)
 
 
-@dp.message(Command("status"))
+@cmd_router.message(Command("status"))
 async def cmd_status(m: Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        session_key = await get_active_session(db, m.from_user.id)
-        if not session_key:
-            await m.answer("Нет активной игры. Нажмите 🎲 Играть.", reply_markup=persistent_reply_menu())
-            return
-        hist = await get_history(db, m.from_user.id, session_key)
-
-    if not hist:
-        await m.answer(f"Активная игра: {session_key}\nПока нет попыток. Пишите имя игрока.")
-        return
-
-    blocks = []
-    for n, guess, fb in hist:
-        blocks.append(f"{n}) {guess}\n{fb}")
-    await m.answer("\n\n".join(blocks))
+    await show_status(m.from_user.id, m.answer)
 
 
-@dp.message(Command("challenge"))
+@cmd_router.message(Command("challenge"))
 async def cmd_challenge(m: Message):
     arg = (m.text or "").split(maxsplit=1)
     if len(arg) < 2:
@@ -760,7 +1043,7 @@ async def cmd_challenge(m: Message):
     await create_challenge_from_query(m, arg[1])
 
 
-@dp.message(Command("join"))
+@cmd_router.message(Command("join"))
 async def cmd_join(m: Message):
     arg = (m.text or "").split(maxsplit=1)
     if len(arg) < 2:
@@ -770,7 +1053,7 @@ async def cmd_join(m: Message):
 
 
 # -------------------- DEV: daily overrides --------------------
-@dp.message(Command("setdaily"))
+@cmd_router.message(Command("setdaily"))
 async def cmd_setdaily(m: Message):
     if not is_dev(m.from_user.id):
         await m.answer("Эта команда доступна только разработчику.")
@@ -788,14 +1071,13 @@ async def cmd_setdaily(m: Message):
         return
 
     q = parts[2].strip()
-    p = resolve_guess_to_player(q)
+    p = resolve_guess_to_player(q, fuzzy=False)
     if not p:
         await m.answer("Не нашли такого игрока. Введите точнее (как в базе).")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await set_daily_override(db, date_iso, p.id, m.from_user.id)
-        await db.commit()
 
     await m.answer(
         "✅ Поставили игрока на дату.\n\n"
@@ -806,7 +1088,7 @@ async def cmd_setdaily(m: Message):
     )
 
 
-@dp.message(Command("cleardaily"))
+@cmd_router.message(Command("cleardaily"))
 async def cmd_cleardaily(m: Message):
     if not is_dev(m.from_user.id):
         await m.answer("Эта команда доступна только разработчику.")
@@ -822,14 +1104,13 @@ async def cmd_cleardaily(m: Message):
         await m.answer("Не поняли дату. Нужно так: YYYY-MM-DD")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await clear_daily_override(db, date_iso)
-        await db.commit()
 
     await m.answer(f"✅ Убрали override на `{date_iso}`. Теперь будет игрок из puzzles.json.", parse_mode="Markdown")
 
 
-@dp.message(Command("getdaily"))
+@cmd_router.message(Command("getdaily"))
 async def cmd_getdaily(m: Message):
     if not is_dev(m.from_user.id):
         await m.answer("Эта команда доступна только разработчику.")
@@ -847,8 +1128,7 @@ async def cmd_getdaily(m: Message):
         day = dt.date.today()
         date_iso = day.isoformat()
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        override_pid = await get_daily_override(db, date_iso)
+    override_pid = await get_daily_override(DB, date_iso)
 
     if override_pid and override_pid in PLAYERS_BY_ID:
         p = PLAYERS_BY_ID[override_pid]
@@ -881,32 +1161,11 @@ async def on_give_up(cb: CallbackQuery):
         await cb.message.answer("Ошибка кнопки 😕")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        active = await get_active_session(db, cb.from_user.id)
-        if not active:
-            await cb.message.answer("Нет активной игры. Нажмите 🎲 Играть.")
-            return
-        if active != session_key:
-            await cb.message.answer("Кнопка относится к другой игре. Откройте текущую игру и нажмите там.")
-            return
-
-        row = await get_session(db, cb.from_user.id, session_key)
-        if not row:
-            await cb.message.answer("Сессия сломалась. Нажмите 🎲 Играть, чтобы начать заново.")
-            return
-
-        answer_id, _attempts, finished = row
-        if finished == 1:
-            await cb.message.answer("Игра уже завершена.")
-            return
-
-        answer = PLAYERS_BY_ID.get(answer_id)
-        if not answer:
-            await cb.message.answer("Не нашли загаданного игрока в базе. Нажмите 🎲 Играть.")
-            return
-
-        await finish_session(db, cb.from_user.id, session_key)
-        await db.commit()
+    async with db_write() as db:
+        answer, error = await apply_give_up(db, cb.from_user.id, session_key)
+    if not answer:
+        await cb.message.answer(error)
+        return
 
     text = (
         "🏳️ Мы сдаёмся.\n\n"
@@ -929,19 +1188,18 @@ async def on_menu(cb: CallbackQuery):
     action = cb.data.split(":", 1)[1]
     await cb.answer()
 
-    fake = Message.model_validate(cb.message.model_dump())
-    fake.from_user = cb.from_user
-
+    # отвечаем в тот же чат, но от имени нажавшего (cb.from_user), а не автора сообщения
+    user_id, reply_fn = cb.from_user.id, cb.message.answer
     if action == "play":
-        await start_random_game(fake)
+        await start_random_game(user_id, reply_fn)
     elif action == "daily":
-        await start_daily_game(fake)
+        await start_daily_game(user_id, reply_fn)
     elif action == "status":
-        await cmd_status(fake)
+        await show_status(user_id, reply_fn)
     elif action == "help":
-        await cmd_help(fake)
+        await show_help(user_id, reply_fn)
     elif action == "challenge":
-        await fake.answer("🎯 Челлендж: выберите действие", reply_markup=challenge_menu_kb())
+        await reply_fn("🎯 Челлендж: выберите действие", reply_markup=challenge_menu_kb())
 
 
 # --------- Challenge submenu callbacks ----------
@@ -950,15 +1208,14 @@ async def on_challenge_menu(cb: CallbackQuery):
     action = cb.data.split(":", 1)[1]
     await cb.answer()
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        if action == "create":
+    if action == "create":
+        async with db_write() as db:
             await set_flow(db, cb.from_user.id, "challenge_create")
-            await db.commit()
-            await cb.message.answer("Ок! Напишите имя игрока для челленджа (пример: Boga)")
-        elif action == "join":
+        await cb.message.answer("Ок! Напишите имя игрока для челленджа (пример: Boga)")
+    elif action == "join":
+        async with db_write() as db:
             await set_flow(db, cb.from_user.id, "challenge_join")
-            await db.commit()
-            await cb.message.answer("Ок! Введите код (пример: ABC123)")
+        await cb.message.answer("Ок! Введите код (пример: ABC123)")
 
 
 # -------------------- Inline suggestions callback --------------------
@@ -971,80 +1228,73 @@ async def on_suggest_click(cb: CallbackQuery):
         await cb.answer("Ошибка кнопки 😕", show_alert=True)
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        row = await get_suggestions(db, cb.from_user.id)
-        if not row:
-            await cb.answer("Подсказки устарели. Напишите запрос заново.", show_alert=True)
-            return
-
-        saved_token, purpose, choices = row
-        if saved_token != token:
-            await cb.answer("Подсказки устарели. Напишите запрос заново.", show_alert=True)
-            return
-        if idx < 1 or idx > len(choices):
-            await cb.answer("Неверный выбор.", show_alert=True)
-            return
-
-        pid = choices[idx - 1]
-        await clear_suggestions(db, cb.from_user.id)
-
-        p = PLAYERS_BY_ID.get(pid)
+    error = ""
+    p = None
+    code = None
+    # проверка и сброс подсказок идут без await между ними — повторный клик не пройдёт
+    row = get_suggestions(cb.from_user.id)
+    if not row or row[0] != token:
+        error = "Подсказки устарели. Напишите запрос заново."
+    elif idx < 1 or idx > len(row[2]):
+        error = "Неверный выбор."
+    else:
+        _saved_token, purpose, choices = row
+        clear_suggestions(cb.from_user.id)
+        p = PLAYERS_BY_ID.get(choices[idx - 1])
         if not p:
-            await db.commit()
-            await cb.answer("Игрок не найден.", show_alert=True)
-            return
-
-        if purpose == "challenge":
-            code = await create_challenge(db, cb.from_user.id, p.id)
-            await set_flow(db, cb.from_user.id, None)
-            await db.commit()
-            await cb.answer()
-
-            text = (
-                "✅ Челлендж создан!\n\n"
-                "Код:\n"
-                f"`{code}`\n\n"
-                "Отправьте другу код.\n\n"
-                "Для запуска:\n"
-                f"`/join {code}`"
-            )
-            try:
-                await cb.message.edit_text(text, parse_mode="Markdown")
-            except Exception:
-                await cb.message.answer(text, parse_mode="Markdown")
-            return
-
-        await db.commit()
+            error = "Игрок не найден."
+        elif purpose == "challenge":
+            async with db_write() as db:
+                code = await create_challenge(db, cb.from_user.id, p.id)
+                await set_flow(db, cb.from_user.id, None)
+
+    if error:
+        await cb.answer(error, show_alert=True)
+        return
 
     await cb.answer()
+    if code:
+        text = (
+            "✅ Челлендж создан!\n\n"
+            "Код:\n"
+            f"`{code}`\n\n"
+            "Отправьте другу код.\n\n"
+            "Для запуска:\n"
+            f"`/join {code}`"
+        )
+        try:
+            await cb.message.edit_text(text, parse_mode="Markdown")
+        except Exception:
+            await cb.message.answer(text, parse_mode="Markdown")
+        return
+
     await handle_guess(cb.from_user.id, cb.message.answer, p)
 
 
 # -------------------- Text input (menu + flows + guesses) --------------------
-@dp.message(F.text)
+@text_router.message(F.text)
 async def on_text(m: Message):
     txt = (m.text or "").strip()
 
     # 1) Reply-keyboard menu buttons
     if txt == "🎲 Играть":
-        await start_random_game(m)
+        await start_random_game(m.from_user.id, m.answer)
         return
     if txt == "📅 Игра дня":
-        await start_daily_game(m)
+        await start_daily_game(m.from_user.id, m.answer)
         return
     if txt == "📊 Статус":
-        await cmd_status(m)
+        await show_status(m.from_user.id, m.answer)
         return
     if txt == "🆘 Помощь":
-        await cmd_help(m)
+        await show_help(m.from_user.id, m.answer)
         return
     if txt == "🎯 Челлендж":
         await m.answer("🎯 Челлендж: выберите действие", reply_markup=challenge_menu_kb())
         return
 
     # 2) Flow mode handling (Create/Join step-by-step)
-    async with aiosqlite.connect(DB_PATH) as db:
-        mode = await get_flow(db, m.from_user.id)
+    mode = await get_flow(DB, m.from_user.id)
 
     if mode == "challenge_create":
         await create_challenge_from_query(m, txt)
@@ -1061,14 +1311,12 @@ async def on_text(m: Message):
         return
 
     # 4) Guess: substring suggestions
-    sugg = find_players_by_substring(txt, limit=SUGGEST_LIMIT)
+    sugg = suggest_players(txt)
     if not sugg:
         await m.answer("❓ Не нашли такого игрока. Попробуйте другое написание (минимум 3 символа).")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        token = await set_suggestions(db, m.from_user.id, [x.id for x in sugg], purpose="guess")
-        await db.commit()
+    token = set_suggestions(m.from_user.id, [x.id for x in sugg], purpose="guess")
 
     kb = build_suggest_kb(token, sugg)
     await m.answer("🔎 Нашли похожих — выберите кнопкой:", reply_markup=kb)
@@ -1077,9 +1325,11 @@ async def on_text(m: Message):
 # -------------------- Run --------------------
 async def main():
     await init_db()
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await DB.close()
 
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
@@ -0,0 +1,72 @@
+# feedback.py
+# Чистые функции фидбека (Spotle-like) — горячий путь каждой попытки.
+# Модуль не тянет bot.py: модели лежат в models.py.
+from functools import lru_cache
+from typing import Dict, Final, Tuple
+
+from models import Player
+
+GREEN: Final = "🟩"
+YELLOW: Final = "🟨"
+GREY: Final = "⬜️"
+
+POS_RU: Dict[str, str] = {"GK": "Вратарь", "DEF": "Защитник", "MID": "Полузащитник", "FWD": "Нападающий"}
+
+
+def country_color(
+    guess_country_n: str, guess_continent: str, answer_country_n: str, answer_continent: str
+) -> str:
+    # страны и континенты предвычислены при загрузке (Player.country_n / .continent)
+    if guess_country_n == answer_country_n:
+        return GREEN
+    if guess_continent != "unknown" and guess_continent == answer_continent:
+        return YELLOW
+    return GREY
+
+
+# индекс = знак (answer - guess) + 1: 0 -> ниже, 1 -> точно, 2 -> выше
+_ARROWS: Final[Tuple[str, str, str]] = ("⬇️", "✅", "⬆️")
+
+
+def arrow_need(guess_val: int, answer_val: int) -> str:
+    return _ARROWS[(answer_val > guess_val) - (answer_val < guess_val) + 1]
+
+
+# индекс = (точно)*2 + (близко): 0 -> мимо, 1 -> близко, 3 -> точно
+_COLORS: Final[Tuple[str, str, str, str]] = (GREY, YELLOW, GREEN, GREEN)
+
+
+def color_numeric(guess_val: int, answer_val: int, near_delta: int) -> str:
+    return _COLORS[(guess_val == answer_val) * 2 + (abs(guess_val - answer_val) <= near_delta)]
+
+
+def color_bool(ok: bool) -> str:
+    return _COLORS[ok * 2]
+
+
+# различных стоимостей в players.json пара сотен — кэш работает как таблица
+# готовых строк; округление целочисленное (half-even, как раньше у :.0f)
+@lru_cache(maxsize=1024)
+def fmt_money_eur(v: int) -> str:
+    if v >= 1_000_000:
+        return f"€{round(v, -6) // 1_000_000}m"
+    if v >= 1_000:
+        return f"€{round(v, -3) // 1_000}k"
+    return f"€{v}"
+
+
+def build_feedback_spotle_multiline(guess: Player, answer: Player) -> str:
+    club_value = f"{guess.club_emoji} {guess.iconic_club}".strip()
+    # одна f-строка на весь фидбек — без промежуточного списка строк
+    return (
+        f"{color_numeric(guess.debut_year, answer.debut_year, 2)} Debut: {guess.debut_year} "
+        f"{arrow_need(guess.debut_year, answer.debut_year)}\n"
+        f"{color_bool(guess.club_n == answer.club_n)} Club: {club_value}\n"
+        f"{color_numeric(guess.fifa_rating, answer.fifa_rating, 20)} FIFA: {guess.fifa_rating} "
+        f"{arrow_need(guess.fifa_rating, answer.fifa_rating)}\n"
+        f"{color_numeric(guess.value_eur, answer.value_eur, 5_000_000)} Value: {fmt_money_eur(guess.value_eur)} "
+        f"{arrow_need(guess.value_eur, answer.value_eur)}\n"
+        f"{color_bool(guess.position_group == answer.position_group)} Position: "
+        f"{POS_RU.get(guess.position_group, guess.position_group)}\n"
+        f"{country_color(guess.country_n, guess.continent, answer.country_n, answer.continent)} Nationality: {guess.birth_country}"
+    )
@@ -0,0 +1,22 @@
+# models.py
+from dataclasses import dataclass
+from typing import Tuple
+
+
+@dataclass(slots=True, frozen=True)
+class Player:
+    id: str
+    name: str
+    aliases: Tuple[str, ...]
+    debut_year: int
+    iconic_club: str
+    fifa_rating: int
+    value_eur: int
+    position_group: str  # GK/DEF/MID/FWD
+    birth_country: str
+    club_emoji: str = ""
+    # предвычисленные при загрузке ключи (поиск и сравнение в фидбеке)
+    name_n: str = ""  # norm(name)
+    club_n: str = ""  # norm(iconic_club)
+    country_n: str = ""  # norm_country(birth_country)
+    continent: str = "unknown"  # COUNTRY_TO_CONTINENT[country_n]